@@ -0,0 +1,353 @@
+"""Match HMLR overseas-company proprietors against the ROE register.
+
+Reads the newest monthly HMLR OCOD extract, pulls the ROE corporate body
+table from Oracle, normalises company names on both sides and reports the
+proprietors/entities that do not appear on the other side.
+"""
+
+import os
+import re
+from datetime import date, datetime
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import pyarrow.compute as pc
+from cleanco.termdata import terms_by_country, terms_by_type
+from sqlalchemy import create_engine
+
+pa.set_cpu_count(os.cpu_count())
+
+HMLR_FOLDER = Path(os.environ.get("HMLR_FOLDER", "data/hmlr"))
+EXCLUSIONS_FOLDER = Path(os.environ.get("EXCLUSIONS_FOLDER", "data/exclusions"))
+OUTPUT_FOLDER = Path(os.environ.get("OUTPUT_FOLDER", "output"))
+CACHE_FOLDER = Path(os.environ.get("CACHE_FOLDER", "cache"))
+
+HMLR_FILE_PATTERN = re.compile(r"OCOD_FULL_(\d{4})_(\d{2})\.xlsx")
+EXCLUSIONS_FILE_PATTERN = re.compile(r"exclusions_(\d{4})-(\d{2})-(\d{2})\.xlsx")
+
+# _NON_WORD (Python re, where \w is Unicode) normalises cleanco's terms at
+# import time. The Arrow kernels use RE2, where \w is ASCII-only and would
+# delete accented letters, so the equivalent classes are spelled with
+# explicit Unicode properties: both strips must keep the same characters or
+# non-ASCII names (routine on an overseas-entity register) stop matching.
+_NON_WORD = re.compile(r"[^\w\s]")
+_NON_WORD_RE2 = r"[^\p{L}\p{N}_\s]"
+_SRL_RE2 = r"\ss[\p{L}\p{N}_]\srl$"
+
+
+def _legal_terms_pattern():
+    """Build one anchored alternation over cleanco's legal-suffix terms.
+
+    cleanco's basename endswith-tests each of its hundreds of terms per
+    name; a single longest-first alternation regex (matching cleanco's
+    longest-suffix-wins semantics) does the same strip in one scan. The
+    terms are normalised the same way as the names they will match against:
+    lowercased with punctuation stripped.
+    """
+    terms = set()
+    for term_lists in (terms_by_type.values(), terms_by_country.values()):
+        for term_list in term_lists:
+            terms.update(_NON_WORD.sub("", term.lower()) for term in term_list)
+    terms.discard("")
+    alternation = "|".join(
+        re.escape(term) for term in sorted(terms, key=len, reverse=True)
+    )
+    return re.compile(r"\s+(?:" + alternation + r")$")
+
+
+_LEGAL_TERMS = _legal_terms_pattern()
+
+# Oracle does the lowercase/punctuation-strip half of the name cleaning in
+# the SELECT; Python only finishes with the suffix strip on uniques. In a
+# UTF-8 session [:alnum:] keeps accented letters and digits, matching the
+# \p{L}\p{N}_ policy of the Arrow kernels; check_sql_clean_agreement in
+# main verifies the two halves have not drifted.
+ROE_QUERY = """
+    SELECT incorporation_number, corporate_body_name,
+           LOWER(REGEXP_REPLACE(corporate_body_name, '[^[:alnum:][:space:]_]', ''))
+               AS clean_company_name_raw,
+           incorporation_date
+    FROM corporate_body
+    WHERE incorporation_number LIKE 'OE%'
+"""
+
+SHARED_HMLR_COLUMNS = [
+    "title_number",
+    "tenure",
+    "property_address",
+    "district",
+    "county",
+    "region",
+    "postcode",
+    "price_paid",
+]
+
+PROPRIETOR_COLUMN_STUBS = [
+    "proprietor_name",
+    "company_registration_no",
+    "proprietorship_category",
+    "country_incorporated",
+    "proprietor_address_1",
+    "proprietor_address_2",
+    "proprietor_address_3",
+]
+
+
+def clean_company_name(company_name):
+    """Normalise a single company name for matching.
+
+    Delegates to clean_company_names so the scalar and Series paths cannot
+    disagree on edge cases such as non-ASCII names.
+    """
+    return clean_company_names(pd.Series([str(company_name)])).iloc[0]
+
+
+def clean_company_names(names, pre_cleaned=False):
+    """Normalise a Series of company names for matching.
+
+    Proprietor names repeat heavily (the same company owns many titles), so
+    the cleaning is computed once per unique name and mapped back onto the
+    full column. The per-unique work runs through PyArrow's multithreaded
+    C++ string kernels rather than pandas object-dtype str ops.
+
+    Pass pre_cleaned=True when the names are already lowercased and
+    punctuation-stripped (the ROE query does that half in SQL).
+    """
+    # factorize gives the uniques and each row's code in one hashing pass,
+    # so the cleaned uniques broadcast back with a take instead of a second
+    # per-row dict lookup.
+    codes, uniq = names.factorize()
+    arr = pa.array(uniq, type=pa.string())
+    if not pre_cleaned:
+        arr = pc.utf8_lower(arr)
+        arr = pc.replace_substring_regex(arr, _NON_WORD_RE2, "")
+    arr = pc.replace_substring_regex(arr, _LEGAL_TERMS.pattern, "")
+    arr = pc.replace_substring_regex(arr, _SRL_RE2, "")
+    arr = pc.replace_substring(arr, " ", "")
+    cleaned = arr.to_numpy(zero_copy_only=False)
+    return pd.Series(cleaned.take(codes), index=names.index)
+
+
+def _hmlr_column_renames():
+    """Map the HMLR extract headers to snake_case column names."""
+    renames = {
+        "Title Number": "title_number",
+        "Tenure": "tenure",
+        "Property Address": "property_address",
+        "District": "district",
+        "County": "county",
+        "Region": "region",
+        "Postcode": "postcode",
+        "Price Paid": "price_paid",
+    }
+    for i in range(1, 5):
+        renames[f"Proprietor Name ({i})"] = f"proprietor_name_{i}"
+        renames[f"Company Registration No. ({i})"] = f"company_registration_no_{i}"
+        renames[f"Proprietorship Category ({i})"] = f"proprietorship_category_{i}"
+        renames[f"Country Incorporated ({i})"] = f"country_incorporated_{i}"
+        for j in range(1, 4):
+            renames[f"Proprietor ({i}) Address ({j})"] = f"proprietor_address_{j}_{i}"
+    return renames
+
+
+HMLR_COLUMN_RENAMES = _hmlr_column_renames()
+
+
+def reshape_hmlr_proprietors(hmlr_df):
+    """Reshape the wide HMLR extract to one row per title/proprietor pair.
+
+    Each output column is allocated once at its final 4*n length and filled
+    with slice assignments, so the reshape is sequential writes into fresh
+    buffers rather than the repeated copies of a concat/stack reshape.
+    """
+    n = len(hmlr_df)
+    out = {
+        column: np.tile(hmlr_df[column].to_numpy(), 4)
+        for column in SHARED_HMLR_COLUMNS
+    }
+    for stub in PROPRIETOR_COLUMN_STUBS:
+        buffer = np.empty(4 * n, dtype=object)
+        for i in range(1, 5):
+            buffer[(i - 1) * n : i * n] = hmlr_df[f"{stub}_{i}"].to_numpy()
+        out[stub] = buffer
+    long_df = pd.DataFrame(out)
+    return long_df.dropna(subset=["proprietor_name"])
+
+
+def get_newest_file(folder, pattern):
+    """Return the path of the newest file in folder matching pattern."""
+    newest_path = None
+    newest_date = None
+    # scandir caches file type from the directory listing, and matching the
+    # name first skips the is_file check (a stat on network drives) for the
+    # unrelated files sharing the folder.
+    with os.scandir(folder) as entries:
+        for entry in entries:
+            match = pattern.match(entry.name)
+            if match and entry.is_file():
+                date_parts = [int(part) for part in match.groups()]
+                while len(date_parts) < 3:
+                    date_parts.append(1)
+                file_date = datetime(*date_parts)
+                if newest_date is None or file_date > newest_date:
+                    newest_path = entry.path
+                    newest_date = file_date
+    if newest_path is None:
+        raise FileNotFoundError(f"No files matching {pattern.pattern} in {folder}")
+    return Path(newest_path)
+
+
+def get_newest_hmlr_file():
+    """Read the newest monthly HMLR OCOD extract."""
+    newest_file = get_newest_file(HMLR_FOLDER, HMLR_FILE_PATTERN)
+    # calamine parses the multi-hundred-MB xlsx far faster than openpyxl's
+    # full-DOM reader, and usecols skips the ~30 columns we never touch.
+    hmlr_df = pd.read_excel(
+        newest_file,
+        engine="calamine",
+        dtype=str,
+        usecols=list(HMLR_COLUMN_RENAMES),
+    )
+    return hmlr_df.rename(columns=HMLR_COLUMN_RENAMES)
+
+
+def get_newest_exclusions_file():
+    """Read the newest manually maintained exclusions list."""
+    newest_file = get_newest_file(EXCLUSIONS_FOLDER, EXCLUSIONS_FILE_PATTERN)
+    # dtype=str matches the HMLR read: a numeric-looking cell in a
+    # hand-maintained sheet would otherwise come back as a float and break
+    # the Arrow string conversion in clean_company_names.
+    return pd.read_excel(newest_file, dtype=str)
+
+
+def write_output(df, stem):
+    """Write an unmatched report as streamed xlsx plus a Parquet sibling."""
+    with pd.ExcelWriter(
+        OUTPUT_FOLDER / f"{stem}.xlsx",
+        engine="xlsxwriter",
+        engine_kwargs={"options": {"constant_memory": True}},
+    ) as writer:
+        df.to_excel(writer, index=False)
+    df.to_parquet(OUTPUT_FOLDER / f"{stem}.parquet", compression="zstd")
+
+
+def get_roe_data():
+    """Pull the ROE corporate body table from the Oracle database.
+
+    The result is cached to Parquet per calendar day, so reruns on the same
+    day skip the Oracle round-trip entirely.
+    """
+    cache = CACHE_FOLDER / f"roe_{date.today()}.parquet"
+    if cache.exists():
+        return pd.read_parquet(cache)
+    engine = create_engine(
+        f"oracle+cx_oracle://{os.environ['ROE_DB_USER']}:{os.environ['ROE_DB_PASSWORD']}"
+        f"@{os.environ['ROE_DB_DSN']}",
+        pool_size=50,
+        arraysize=10000,
+    )
+    roe_df = pd.read_sql_query(ROE_QUERY, engine, dtype_backend="pyarrow")
+    roe_df.columns = roe_df.columns.str.lower()
+    CACHE_FOLDER.mkdir(parents=True, exist_ok=True)
+    roe_df.to_parquet(cache, compression="zstd")
+    return roe_df
+
+
+def check_sql_clean_agreement(roe_df, sample_size=1000):
+    """Check the SQL-cleaned ROE names agree with full Python cleaning.
+
+    The ROE query lowercases and strips punctuation in Oracle; if its
+    character class drifts from the Python side the same registered name
+    lands in both unmatched reports as a false positive, so re-clean a
+    sample of raw names entirely in Python and fail loudly on mismatch.
+    """
+    sample = roe_df.head(sample_size)
+    recleaned = clean_company_names(sample["corporate_body_name"].fillna(""))
+    mismatched = sample["clean_company_name"].ne(recleaned)
+    if mismatched.any():
+        example = sample.loc[mismatched, "corporate_body_name"].iloc[0]
+        raise ValueError(
+            f"SQL and Python name cleaning disagree, e.g. for {example!r}; "
+            "check ROE_QUERY's character class against clean_company_names"
+        )
+
+
+def main():
+    hmlr_df = reshape_hmlr_proprietors(get_newest_hmlr_file())
+    roe_df = get_roe_data()
+    exclusions_df = get_newest_exclusions_file()
+
+    # The name columns are already strings; fillna avoids a full astype(str)
+    # pass and the "nan" literals it used to leave in the cleaned output.
+    hmlr_df["clean_proprietor_name"] = clean_company_names(
+        hmlr_df["proprietor_name"].fillna("")
+    )
+    roe_df["clean_company_name"] = clean_company_names(
+        roe_df["clean_company_name_raw"].fillna(""), pre_cleaned=True
+    )
+    check_sql_clean_agreement(roe_df)
+    roe_df = roe_df.drop(columns=["clean_company_name_raw"])
+    exclusions_df["clean_entity_name"] = clean_company_names(
+        exclusions_df["entity_name"].fillna("")
+    )
+
+    # The cleaned names are highly repetitive, so category dtype lets the
+    # isin/sort/dedup steps work on integer codes instead of strings.
+    hmlr_df["clean_proprietor_name"] = hmlr_df["clean_proprietor_name"].astype(
+        "category"
+    )
+    roe_df["clean_company_name"] = roe_df["clean_company_name"].astype("category")
+
+    # The unmatched computation is a set difference between the unique names
+    # on each side, so do it once on the uniques (the categories hold each
+    # distinct name exactly once) and filter the rows with the far smaller
+    # unmatched set.
+    excl_names = frozenset(exclusions_df["clean_entity_name"].unique())
+    roe_names = frozenset(roe_df["clean_company_name"].cat.categories)
+    hmlr_names = frozenset(hmlr_df["clean_proprietor_name"].cat.categories)
+
+    hmlr_unmatched_names = hmlr_names - roe_names - excl_names
+    roe_unmatched_names = roe_names - hmlr_names - excl_names
+
+    # Index with the raw bool arrays so pandas skips index alignment; the
+    # per-row excluded_bool columns are redundant now that exclusions are
+    # folded into the name-set difference.
+    hmlr_unmatched_in_roe_df = hmlr_df[
+        hmlr_df["clean_proprietor_name"].isin(hmlr_unmatched_names).to_numpy()
+    ]
+    roe_unmatched_in_hmlr_df = roe_df[
+        roe_df["clean_company_name"].isin(roe_unmatched_names).to_numpy()
+    ]
+
+    # Sorting a categorical column runs on its integer codes; dropping the
+    # categories filtered out above keeps the code table small first.
+    hmlr_unmatched_in_roe_df = hmlr_unmatched_in_roe_df.assign(
+        clean_proprietor_name=hmlr_unmatched_in_roe_df[
+            "clean_proprietor_name"
+        ].cat.remove_unused_categories()
+    ).sort_values(by=["clean_proprietor_name"])
+    roe_unmatched_in_hmlr_df = roe_unmatched_in_hmlr_df.assign(
+        clean_company_name=roe_unmatched_in_hmlr_df[
+            "clean_company_name"
+        ].cat.remove_unused_categories()
+    ).sort_values(by=["clean_company_name"])
+
+    print(
+        f"{hmlr_unmatched_in_roe_df['clean_proprietor_name'].nunique()} unique "
+        "HMLR proprietors not found on the ROE register"
+    )
+    print(
+        f"{roe_unmatched_in_hmlr_df['clean_company_name'].nunique()} unique "
+        "ROE entities not found in the HMLR extract"
+    )
+
+    OUTPUT_FOLDER.mkdir(parents=True, exist_ok=True)
+    run_date = datetime.today().strftime("%Y-%m-%d")
+    write_output(hmlr_unmatched_in_roe_df, f"hmlr_unmatched_in_roe_{run_date}")
+    write_output(roe_unmatched_in_hmlr_df, f"roe_unmatched_in_hmlr_{run_date}")
+
+
+if __name__ == "__main__":
+    main()